@@ -31,24 +31,55 @@ from io import BytesIO
 import aspose.words as aw
 from diff_match_patch import diff_match_patch
 
+try:
+    import orjson  # Much faster for the large base64 payloads
+except ImportError:
+    orjson = None
 
-def normalize_text(text: str) -> str:
-    """
-    Normalize text to prevent spurious diffs from quote styles, dashes, etc.
-    Must match the normalizeText() function in route.ts
-    """
-    import re
+# Single-pass normalization table, built once at import
+_NORM_TABLE = str.maketrans({
     # Smart double quotes → straight
-    text = re.sub(r'[\u201C\u201D\u201E\u201F\u2033\u2036]', '"', text)
+    **dict.fromkeys([0x201C, 0x201D, 0x201E, 0x201F, 0x2033, 0x2036], '"'),
     # Smart single quotes → straight
-    text = re.sub(r'[\u2018\u2019\u201A\u201B\u2032\u2035]', "'", text)
+    **dict.fromkeys([0x2018, 0x2019, 0x201A, 0x201B, 0x2032, 0x2035], "'"),
     # En/em dashes → hyphen
-    text = re.sub(r'[\u2013\u2014\u2015]', '-', text)
+    **dict.fromkeys([0x2013, 0x2014, 0x2015], '-'),
     # Non-breaking/special spaces → regular
-    text = re.sub(r'[\u00A0\u2000-\u200B]', ' ', text)
+    **dict.fromkeys([0x00A0, *range(0x2000, 0x200C)], ' '),
     # Ellipsis → three dots
-    text = text.replace('\u2026', '...')
-    return text
+    0x2026: '...',
+})
+
+
+def normalize_text(text: str) -> str:
+    """
+    Normalize text to prevent spurious diffs from quote styles, dashes, etc.
+    Must match the normalizeText() function in route.ts
+    """
+    return text.translate(_NORM_TABLE)
+
+
+def equal_neighbors(diffs: list) -> tuple:
+    """
+    For each diff index, find the text of the nearest EQUAL segment before
+    and after it (None at the ends), in two linear passes.
+    """
+    prev_equal = [None] * len(diffs)
+    next_equal = [None] * len(diffs)
+
+    last = None
+    for j, (op, text) in enumerate(diffs):
+        prev_equal[j] = last
+        if op == 0:
+            last = text
+
+    last = None
+    for j in range(len(diffs) - 1, -1, -1):
+        next_equal[j] = last
+        if diffs[j][0] == 0:
+            last = diffs[j][1]
+
+    return prev_equal, next_equal
 
 
 def extract_word_level_edits(original_text: str, modified_text: str) -> list:
@@ -67,6 +98,7 @@ def extract_word_level_edits(original_text: str, modified_text: str) -> list:
     # Get character-level diff on NORMALIZED text
     diffs = dmp.diff_main(normalized_original, normalized_modified)
     dmp.diff_cleanupSemantic(diffs)
+    prev_equal, next_equal = equal_neighbors(diffs)
 
     edits = []
     i = 0
@@ -97,20 +129,16 @@ def extract_word_level_edits(original_text: str, modified_text: str) -> list:
                 context_after = ""
 
                 # Get some context from previous equal section
-                for j in range(i - 1, -1, -1):
-                    if diffs[j][0] == 0:
-                        words = diffs[j][1].split()
-                        if words:
-                            context_before = words[-1] + " " if len(words[-1]) > 2 else ""
-                        break
+                if prev_equal[i] is not None:
+                    words = prev_equal[i].split()
+                    if words:
+                        context_before = words[-1] + " " if len(words[-1]) > 2 else ""
 
                 # Get some context from next equal section
-                for j in range(i + 1, len(diffs)):
-                    if diffs[j][0] == 0:
-                        words = diffs[j][1].split()
-                        if words:
-                            context_after = " " + words[0] if len(words[0]) > 2 else ""
-                        break
+                if next_equal[i] is not None:
+                    words = next_equal[i].split()
+                    if words:
+                        context_after = " " + words[0] if len(words[0]) > 2 else ""
 
                 find_text = context_before + deleted_text + context_after
                 replace_text = context_before + inserted_text + context_after
@@ -137,20 +165,51 @@ def extract_word_level_edits(original_text: str, modified_text: str) -> list:
     return edits
 
 
+def replace_in_paragraphs(doc, paragraphs: list, find_text: str, replace_text: str, options) -> int:
+    """
+    Run one find/replace against only the paragraphs whose text contains
+    find_text, instead of walking the whole document for every edit.
+
+    `paragraphs` is a list of (node, text, lowered text) captured before any
+    edits. Falls back to the whole document when no paragraph contains the
+    text (e.g. it spans paragraphs), so results match a doc-wide replace.
+    """
+    if options.match_case:
+        candidates = [node for node, text, _ in paragraphs if find_text in text]
+    else:
+        needle = find_text.lower()
+        candidates = [node for node, _, lowered in paragraphs if needle in lowered]
+
+    matches = sum(node.range.replace(find_text, replace_text, options) for node in candidates)
+    if matches == 0:
+        matches = doc.range.replace(find_text, replace_text, options)
+    return matches
+
+
 def generate_redlined_docx(original_base64: str, original_text: str, modified_text: str, author: str = "MARS AI Review") -> dict:
     """
     Generate a DOCX with track changes.
     """
     try:
-        # Decode original document
-        original_bytes = base64.b64decode(original_base64)
+        # Decode original document straight into the stream it loads from
+        doc_stream = BytesIO(base64.b64decode(original_base64))
 
         # Verify it's a valid DOCX (ZIP magic bytes)
-        if original_bytes[:4] != b'PK\x03\x04':
+        if doc_stream.read(4) != b'PK\x03\x04':
             return {'success': False, 'error': 'Invalid DOCX file format'}
+        doc_stream.seek(0)
+
+        # Nothing to redline - skip loading the document entirely
+        if normalize_text(original_text) == normalize_text(modified_text):
+            return {
+                'success': True,
+                'docxBase64': original_base64,
+                'editsApplied': 0,
+                'editsTotal': 0,
+                'revisionsCount': 0
+            }
 
         # Load document from bytes
-        doc_stream = BytesIO(original_bytes)
         doc = aw.Document(doc_stream)
 
         # Extract edits using diff-match-patch
@@ -158,6 +217,16 @@ def generate_redlined_docx(original_base64: str, original_text: str, modified_te
 
         print(f"Found {len(edits)} edits to apply", file=sys.stderr)
 
+        # Index paragraph text once, before any edits, to scope each replace.
+        # Paragraphs inside text boxes/shapes are skipped: their text is already
+        # part of the enclosing paragraph's range, so they'd be replaced twice.
+        paragraphs = []
+        for node in doc.get_child_nodes(aw.NodeType.PARAGRAPH, True):
+            if node.get_ancestor(aw.NodeType.PARAGRAPH) is not None:
+                continue
+            text = node.get_text()
+            paragraphs.append((node, text, text.lower()))
+
         # Start tracking revisions
         doc.start_track_revisions(author, datetime.now())
 
@@ -165,6 +234,7 @@ def generate_redlined_docx(original_base64: str, original_text: str, modified_te
         applied_count = 0
         options = aw.replacing.FindReplaceOptions()
         options.match_case = True  # Use case-sensitive for precise matching
+        options.ignore_deleted = True  # Don't re-match text an earlier edit already deleted
 
         for edit in edits:
             find_text = edit['find']
@@ -177,7 +247,7 @@ def generate_redlined_docx(original_base64: str, original_text: str, modified_te
 
             try:
                 # Try exact match first
-                matches = doc.range.replace(find_text, replace_text, options)
+                matches = replace_in_paragraphs(doc, paragraphs, find_text, replace_text, options)
 
                 if matches > 0:
                     applied_count += 1
@@ -185,7 +255,7 @@ def generate_redlined_docx(original_base64: str, original_text: str, modified_te
                 else:
                     # Try case-insensitive if exact match fails
                     options.match_case = False
-                    matches = doc.range.replace(find_text, replace_text, options)
+                    matches = replace_in_paragraphs(doc, paragraphs, find_text, replace_text, options)
                     options.match_case = True
 
                     if matches > 0:
@@ -203,10 +273,11 @@ def generate_redlined_docx(original_base64: str, original_text: str, modified_te
         # Save to bytes
         output_stream = BytesIO()
         doc.save(output_stream, aw.SaveFormat.DOCX)
-        output_bytes = output_stream.getvalue()
 
-        # Encode result
-        result_base64 = base64.b64encode(output_bytes).decode('utf-8')
+        # Encode result from the stream's buffer without copying it out first
+        with output_stream.getbuffer() as output_view:
+            result_base64 = base64.b64encode(output_view).decode('utf-8')
+        output_stream.close()
 
         return {
             'success': True,
@@ -225,11 +296,27 @@ def generate_redlined_docx(original_base64: str, original_text: str, modified_te
         }
 
 
+def read_json_input() -> dict:
+    """Parse the JSON request from stdin, using orjson when available."""
+    if orjson is not None:
+        return orjson.loads(sys.stdin.buffer.read())
+    return json.load(sys.stdin)
+
+
+def write_json_output(result: dict) -> None:
+    """Write the JSON response to stdout, using orjson when available."""
+    if orjson is not None:
+        sys.stdout.buffer.write(orjson.dumps(result) + b'\n')
+        sys.stdout.buffer.flush()
+    else:
+        print(json.dumps(result))
+
+
 def main():
     """Read JSON from stdin, process, write JSON to stdout."""
     try:
         # Read input
-        input_data = json.load(sys.stdin)
+        input_data = read_json_input()
 
         original_base64 = input_data.get('originalDocxBase64', '')
         original_text = input_data.get('originalText', '')
@@ -237,23 +324,23 @@ def main():
         author = input_data.get('author', 'MARS AI Review')
 
         if not original_base64:
-            print(json.dumps({'success': False, 'error': 'originalDocxBase64 is required'}))
+            write_json_output({'success': False, 'error': 'originalDocxBase64 is required'})
             return
 
         if not original_text or not modified_text:
-            print(json.dumps({'success': False, 'error': 'originalText and modifiedText are required'}))
+            write_json_output({'success': False, 'error': 'originalText and modifiedText are required'})
             return
 
         # Generate redlined document
         result = generate_redlined_docx(original_base64, original_text, modified_text, author)
 
         # Output result
-        print(json.dumps(result))
+        write_json_output(result)
 
     except json.JSONDecodeError as e:
-        print(json.dumps({'success': False, 'error': f'Invalid JSON input: {str(e)}'}))
+        write_json_output({'success': False, 'error': f'Invalid JSON input: {str(e)}'})
     except Exception as e:
-        print(json.dumps({'success': False, 'error': f'Unexpected error: {str(e)}'}))
+        write_json_output({'success': False, 'error': f'Unexpected error: {str(e)}'})
 
 
 if __name__ == '__main__':
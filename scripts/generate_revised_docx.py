@@ -21,34 +21,105 @@ Output (JSON to stdout):
 import sys
 import json
 import base64
+import bisect
 import re
+from functools import lru_cache
 from io import BytesIO
 
 from docx import Document
 from diff_match_patch import diff_match_patch
 
+try:
+    import orjson  # Much faster for the large base64 payloads
+except ImportError:
+    orjson = None
 
-def normalize_for_matching(text: str) -> str:
-    """Normalize text for matching."""
+# Single-pass normalization table, built once at import
+_NORM_TABLE = str.maketrans({
     # Normalize quotes
-    text = re.sub(r'[\u201C\u201D\u201E\u201F\u2033\u2036]', '"', text)
-    text = re.sub(r'[\u2018\u2019\u201A\u201B\u2032\u2035]', "'", text)
+    **dict.fromkeys([0x201C, 0x201D, 0x201E, 0x201F, 0x2033, 0x2036], '"'),
+    **dict.fromkeys([0x2018, 0x2019, 0x201A, 0x201B, 0x2032, 0x2035], "'"),
     # Normalize dashes
-    text = re.sub(r'[\u2013\u2014\u2015]', '-', text)
+    **dict.fromkeys([0x2013, 0x2014, 0x2015], '-'),
+})
+_RE_NONSPACE = re.compile(r'\S+')
+
+
+@lru_cache(maxsize=4096)
+def normalize_for_matching(text: str) -> str:
+    """Normalize text for matching."""
+    text = text.translate(_NORM_TABLE)
     # Collapse whitespace
-    text = re.sub(r'\s+', ' ', text)
-    return text.strip()
+    return ' '.join(text.split())
+
+
+def locate_normalized(text: str, norm_find: str):
+    """
+    Find norm_find in normalize_for_matching(text) and return the matching
+    (start, end) span of the un-normalized text, or None if absent.
+    """
+    # The translate table is 1:1, so only whitespace collapsing moves offsets
+    tokens = list(_RE_NONSPACE.finditer(text.translate(_NORM_TABLE)))
+    norm_starts = []
+    offset = 0
+    for m in tokens:
+        norm_starts.append(offset)
+        offset += len(m.group()) + 1
+
+    pos = ' '.join(m.group() for m in tokens).find(norm_find)
+    if pos == -1 or not norm_find:
+        return None
+
+    def to_raw(norm_pos: int) -> int:
+        k = bisect.bisect_right(norm_starts, norm_pos) - 1
+        return tokens[k].start() + norm_pos - norm_starts[k]
+
+    # norm_find is stripped, so its first and last characters sit inside tokens
+    return to_raw(pos), to_raw(pos + len(norm_find) - 1) + 1
+
+
+def normalize_lines(text: str) -> str:
+    """
+    Normalize each line for matching but keep the line breaks, so diff_main
+    can run its line-level pass before refining the changed lines.
+    """
+    return '\n'.join(filter(None, map(normalize_for_matching, text.splitlines())))
+
+
+def equal_neighbors(diffs: list) -> tuple:
+    """
+    For each diff index, find the text of the nearest EQUAL segment before
+    and after it (None at the ends), in two linear passes.
+    """
+    prev_equal = [None] * len(diffs)
+    next_equal = [None] * len(diffs)
+
+    last = None
+    for j, (op, text) in enumerate(diffs):
+        prev_equal[j] = last
+        if op == 0:
+            last = text
+
+    last = None
+    for j in range(len(diffs) - 1, -1, -1):
+        next_equal[j] = last
+        if diffs[j][0] == 0:
+            last = diffs[j][1]
+
+    return prev_equal, next_equal
 
 
 def extract_replacements(original_text: str, modified_text: str) -> list:
     """Extract find/replace pairs from the diff."""
     dmp = diff_match_patch()
 
-    norm_original = normalize_for_matching(original_text)
-    norm_modified = normalize_for_matching(modified_text)
+    # Keep paragraph breaks so the diff can run line-by-line on long documents
+    norm_original = normalize_lines(original_text)
+    norm_modified = normalize_lines(modified_text)
 
     diffs = dmp.diff_main(norm_original, norm_modified)
     dmp.diff_cleanupSemantic(diffs)
+    prev_equal, next_equal = equal_neighbors(diffs)
 
     replacements = []
     i = 0
@@ -72,38 +143,35 @@ def extract_replacements(original_text: str, modified_text: str) -> list:
             if deleted.strip() or inserted.strip():
                 # Get context
                 context_before = ""
-                for j in range(i - 1, -1, -1):
-                    if diffs[j][0] == 0:
-                        ctx = diffs[j][1]
-                        if len(ctx) > 40:
-                            ctx = ctx[-40:]
-                            space_pos = ctx.find(' ')
-                            if space_pos > 0:
-                                ctx = ctx[space_pos + 1:]
-                        context_before = ctx
-                        break
+                if prev_equal[i] is not None:
+                    ctx = prev_equal[i]
+                    if len(ctx) > 40:
+                        ctx = ctx[-40:]
+                        space_pos = ctx.find(' ')
+                        if space_pos > 0:
+                            ctx = ctx[space_pos + 1:]
+                    context_before = ctx
 
                 context_after = ""
-                for j in range(i + 1, len(diffs)):
-                    if diffs[j][0] == 0:
-                        ctx = diffs[j][1]
-                        if len(ctx) > 40:
-                            ctx = ctx[:40]
-                            space_pos = ctx.rfind(' ')
-                            if space_pos > 0:
-                                ctx = ctx[:space_pos]
-                        context_after = ctx
-                        break
-
-                find_text = context_before + deleted + context_after
-                replace_text = context_before + inserted + context_after
-
-                if find_text.strip() and find_text != replace_text:
+                if next_equal[i] is not None:
+                    ctx = next_equal[i]
+                    if len(ctx) > 40:
+                        ctx = ctx[:40]
+                        space_pos = ctx.rfind(' ')
+                        if space_pos > 0:
+                            ctx = ctx[:space_pos]
+                    context_after = ctx
+
+                # Collapse line breaks back out; matching is per paragraph
+                find_text = ' '.join((context_before + deleted + context_after).split())
+                replace_text = ' '.join((context_before + inserted + context_after).split())
+
+                if find_text and find_text != replace_text:
                     replacements.append({
-                        'find': find_text.strip(),
-                        'replace': replace_text.strip(),
-                        'deleted': deleted.strip()[:50],
-                        'inserted': inserted.strip()[:50]
+                        'find': find_text,
+                        'replace': replace_text,
+                        'deleted': ' '.join(deleted.split())[:50],
+                        'inserted': ' '.join(inserted.split())[:50]
                     })
 
         i += 1
@@ -111,37 +179,34 @@ def extract_replacements(original_text: str, modified_text: str) -> list:
     return replacements
 
 
-def replace_in_paragraph(paragraph, find_text: str, replace_text: str) -> bool:
-    """Replace text in a paragraph while preserving formatting."""
-    # Get full paragraph text
-    full_text = paragraph.text
+def replace_in_paragraph(paragraph, find_text: str, replace_text: str,
+                         norm_find: str = None, norm_full: str = None) -> bool:
+    """
+    Replace text in a paragraph while preserving formatting.
 
+    Callers scanning many paragraphs can pass the already-normalized
+    find text and paragraph text to avoid renormalizing them per call.
+    """
     # Normalize for matching
-    norm_full = normalize_for_matching(full_text)
-    norm_find = normalize_for_matching(find_text)
+    if norm_full is None:
+        norm_full = normalize_for_matching(paragraph.text)
+    if norm_find is None:
+        norm_find = normalize_for_matching(find_text)
 
     if norm_find not in norm_full:
         return False
 
-    # Find the position in normalized text
-    pos = norm_full.find(norm_find)
-    if pos == -1:
-        return False
-
     # For simple cases, do direct replacement
     # This preserves the paragraph's runs but replaces text
     for run in paragraph.runs:
-        if find_text in run.text:
-            run.text = run.text.replace(find_text, replace_text)
+        run_text = run.text
+        if find_text in run_text:
+            run.text = run_text.replace(find_text, replace_text, 1)
             return True
-        # Also try normalized matching
-        norm_run = normalize_for_matching(run.text)
-        if norm_find in norm_run:
-            # Replace with smart quotes preserved
-            run.text = run.text.replace(run.text, run.text.replace(
-                next((s for s in [find_text, norm_find] if s in run.text), find_text),
-                replace_text
-            ))
+        # Also try normalized matching, mapped back onto the original span
+        if norm_find in normalize_for_matching(run_text):
+            start, end = locate_normalized(run_text, norm_find)
+            run.text = run_text[:start] + replace_text + run_text[end:]
             return True
 
     return False
@@ -150,52 +215,67 @@ def replace_in_paragraph(paragraph, find_text: str, replace_text: str) -> bool:
 def generate_revised_docx(original_base64: str, original_text: str, modified_text: str) -> dict:
     """Modify the original DOCX with AI changes, preserving formatting."""
     try:
-        # Decode original document
-        original_bytes = base64.b64decode(original_base64)
+        # Decode original document straight into the stream it loads from
+        doc_stream = BytesIO(base64.b64decode(original_base64))
 
-        if original_bytes[:4] != b'PK\x03\x04':
+        if doc_stream.read(4) != b'PK\x03\x04':
             return {'success': False, 'error': 'Invalid DOCX file'}
+        doc_stream.seek(0)
+
+        # Nothing to revise - skip loading the document entirely
+        if normalize_for_matching(original_text) == normalize_for_matching(modified_text):
+            return {
+                'success': True,
+                'docxBase64': original_base64,
+                'changesApplied': 0,
+                'changesTotal': 0
+            }
 
         # Load document with python-docx
-        doc_stream = BytesIO(original_bytes)
         doc = Document(doc_stream)
 
         # Extract replacements from diff
         replacements = extract_replacements(original_text, modified_text)
         print(f"Found {len(replacements)} replacements", file=sys.stderr)
 
+        # Skip short matches
+        eligible = [rep for rep in replacements if len(rep['find']) >= 20]
+        norm_finds = [normalize_for_matching(rep['find']) for rep in eligible]
+
         applied_count = 0
 
-        for rep in replacements:
-            find_text = rep['find']
-            replace_text = rep['replace']
-
-            # Skip short matches
-            if len(find_text) < 20:
-                continue
-
-            # Try to apply in each paragraph
-            for para in doc.paragraphs:
-                if replace_in_paragraph(para, find_text, replace_text):
-                    applied_count += 1
-                    print(f"Applied: '{rep['deleted'][:30]}' -> '{rep['inserted'][:30]}'", file=sys.stderr)
-                    break
-
-            # Also check tables
-            for table in doc.tables:
-                for row in table.rows:
-                    for cell in row.cells:
-                        for para in cell.paragraphs:
-                            if replace_in_paragraph(para, find_text, replace_text):
-                                applied_count += 1
-                                break
+        if eligible:
+            # Body paragraphs followed by table-cell paragraphs, walked once
+            all_paragraphs = list(doc.paragraphs) + [
+                para
+                for table in doc.tables
+                for row in table.rows
+                for cell in row.cells
+                for para in cell.paragraphs
+            ]
+
+            # Normalize every paragraph once up front; entries are refreshed
+            # only when a replacement changes that paragraph's text
+            entries = [[para, normalize_for_matching(para.text)] for para in all_paragraphs]
+
+            for rep, norm_find in zip(eligible, norm_finds):
+                # Apply in the first matching paragraph only
+                for entry in entries:
+                    para, norm_full = entry
+                    if norm_find in norm_full and replace_in_paragraph(para, rep['find'], rep['replace'], norm_find, norm_full):
+                        entry[1] = normalize_for_matching(para.text)
+                        applied_count += 1
+                        print(f"Applied: '{rep['deleted'][:30]}' -> '{rep['inserted'][:30]}'", file=sys.stderr)
+                        break
 
         # Save to bytes
         output_stream = BytesIO()
         doc.save(output_stream)
-        output_bytes = output_stream.getvalue()
 
-        result_base64 = base64.b64encode(output_bytes).decode('utf-8')
+        # Encode from the stream's buffer without copying it out first
+        with output_stream.getbuffer() as output_view:
+            result_base64 = base64.b64encode(output_view).decode('utf-8')
+        output_stream.close()
 
         return {
             'success': True,
@@ -213,29 +293,45 @@ def generate_revised_docx(original_base64: str, original_text: str, modified_tex
         }
 
 
+def read_json_input() -> dict:
+    """Parse the JSON request from stdin, using orjson when available."""
+    if orjson is not None:
+        return orjson.loads(sys.stdin.buffer.read())
+    return json.load(sys.stdin)
+
+
+def write_json_output(result: dict) -> None:
+    """Write the JSON response to stdout, using orjson when available."""
+    if orjson is not None:
+        sys.stdout.buffer.write(orjson.dumps(result) + b'\n')
+        sys.stdout.buffer.flush()
+    else:
+        print(json.dumps(result))
+
+
 def main():
     try:
-        input_data = json.load(sys.stdin)
+        input_data = read_json_input()
 
         original_base64 = input_data.get('originalDocxBase64', '')
         original_text = input_data.get('originalText', '')
         modified_text = input_data.get('modifiedText', '')
 
         if not original_base64:
-            print(json.dumps({'success': False, 'error': 'originalDocxBase64 required'}))
+            write_json_output({'success': False, 'error': 'originalDocxBase64 required'})
             return
 
         if not original_text or not modified_text:
-            print(json.dumps({'success': False, 'error': 'originalText and modifiedText required'}))
+            write_json_output({'success': False, 'error': 'originalText and modifiedText required'})
             return
 
         result = generate_revised_docx(original_base64, original_text, modified_text)
-        print(json.dumps(result))
+        write_json_output(result)
 
     except json.JSONDecodeError as e:
-        print(json.dumps({'success': False, 'error': f'Invalid JSON: {str(e)}'}))
+        write_json_output({'success': False, 'error': f'Invalid JSON: {str(e)}'})
     except Exception as e:
-        print(json.dumps({'success': False, 'error': f'Error: {str(e)}'}))
+        write_json_output({'success': False, 'error': f'Error: {str(e)}'})
 
 
 if __name__ == '__main__':
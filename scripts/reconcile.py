@@ -5,17 +5,87 @@ Reconciliation script: Compare Excel contracts vs Notion contracts
 
 import pandas as pd
 import requests
+import argparse
 import json
+import re
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass, fields
 from datetime import datetime
+from functools import lru_cache
+from pathlib import Path
+
+try:
+    import httpx  # Optional: persistent HTTP/2 client for Notion pagination
+except ImportError:
+    httpx = None
 
 # Configuration
 import os
 NOTION_TOKEN = os.environ.get('NOTION_API_KEY', '')
 DATABASE_ID = '206736c0-e519-4948-ad03-0786df66e7fc'
 EXCEL_FILE = '/Users/jbb/Downloads/report1767708526119.xls'
-
-def get_notion_contracts():
-    """Fetch all contracts from Notion"""
+NOTION_CACHE_FILE = Path.home() / '.cache' / 'mars_reconcile' / 'notion.json'
+
+# Common suffixes/patterns stripped from company names before matching
+NAME_SUFFIXES = [', inc.', ', inc', ' inc.', ' inc', ', llc', ' llc', ', ltd', ' ltd',
+                 ' corporation', ' corp', ' company', ' co.', ', city of', ' city of',
+                 ', town of', ' town of', ' department', ' dept', ' utilities', ' utility',
+                 ' water district', ' water division', ' water works', ' waterworks',
+                 ' water & sewer', ' water and sewer', ' mcc', ' m3', ' myc', ' (vf-10)',
+                 ' (1 of 3)', ' (1 of 5)', ' (2 of 5)', ' (3 of 5)', '(console upgrade)',
+                 ' - mcc only', ' mcc only', ' renewal', ' license']
+# Longest first, so overlapping suffixes (' - mcc only' vs ' mcc') strip whole
+_SUFFIX_RE = re.compile('|'.join(re.escape(s) for s in sorted(NAME_SUFFIXES, key=len, reverse=True)))
+_TRAILING_PARENS_RE = re.compile(r'\s*\([^)]*\)\s*$')
+_TRAILING_BRACKETS_RE = re.compile(r'\s*\[[^\]]*\]\s*$')
+
+@dataclass(slots=True)
+class NotionContract:
+    id: str
+    name: str
+    name_lower: str
+    value: float
+
+@dataclass(slots=True)
+class ExcelContract:
+    name: str
+    name_lower: str
+    value: float
+    close_date: str
+    stage: str
+    sales_lead: str
+    opportunity_count: int
+
+def parse_notion_page(page):
+    """Extract the contract fields from one Notion page"""
+    props = page.get('properties', {})
+    name = ''
+    if props.get('Name', {}).get('title'):
+        name = props['Name']['title'][0].get('plain_text', '') if props['Name']['title'] else ''
+
+    value = props.get('Contract Value', {}).get('number', 0) or 0
+
+    return NotionContract(
+        id=page['id'],
+        name=name.strip(),
+        name_lower=name.strip().lower(),
+        value=value,
+    )
+
+def open_notion_client(headers):
+    """Persistent Notion client: httpx over HTTP/2 when installed, else a pooled requests.Session"""
+    if httpx is not None:
+        try:
+            return httpx.Client(http2=True, headers=headers)
+        except ImportError:
+            # http2=True needs the optional h2 package
+            return httpx.Client(headers=headers)
+    session = requests.Session()
+    session.headers.update(headers)
+    return session
+
+def query_notion_pages(notion_filter=None):
+    """Fetch all database pages from Notion, optionally filtered"""
     headers = {
         'Authorization': f'Bearer {NOTION_TOKEN}',
         'Notion-Version': '2022-06-28',
@@ -24,139 +94,152 @@ def get_notion_contracts():
 
     url = f'https://api.notion.com/v1/databases/{DATABASE_ID}/query'
     all_results = []
-    has_more = True
-    start_cursor = None
-
-    while has_more:
-        body = {'page_size': 100}
-        if start_cursor:
-            body['start_cursor'] = start_cursor
-
-        response = requests.post(url, headers=headers, json=body)
-        data = response.json()
-
-        all_results.extend(data.get('results', []))
-        has_more = data.get('has_more', False)
-        start_cursor = data.get('next_cursor')
-
-    # Parse results
-    contracts = []
-    for page in all_results:
-        props = page.get('properties', {})
-        name = ''
-        if props.get('Name', {}).get('title'):
-            name = props['Name']['title'][0].get('plain_text', '') if props['Name']['title'] else ''
-
-        value = props.get('Contract Value', {}).get('number', 0) or 0
-
-        contracts.append({
-            'id': page['id'],
-            'name': name.strip(),
-            'name_lower': name.strip().lower(),
-            'value': value,
-        })
 
-    return contracts
+    # One persistent connection for every page
+    with open_notion_client(headers) as client:
+        start_cursor = None
+        while True:
+            body = {'page_size': 100}
+            if notion_filter:
+                body['filter'] = notion_filter
+            if start_cursor:
+                body['start_cursor'] = start_cursor
+            data = client.post(url, json=body, timeout=30).json()
+
+            all_results.extend(data.get('results', []))
+
+            if not data.get('has_more', False):
+                break
+            start_cursor = data.get('next_cursor')
+
+    return all_results
+
+def get_notion_contracts(use_cache=False):
+    """
+    Fetch all contracts from Notion.
+
+    Every run saves the pages to NOTION_CACHE_FILE. With use_cache, only pages
+    edited since the newest cached last_edited_time are fetched and merged in
+    by id. That is opt-in: pages deleted or archived in Notion drop out of
+    query results, so an incremental run still reports them as present.
+    """
+    cached = None
+    if use_cache and NOTION_CACHE_FILE.exists():
+        cached = json.loads(NOTION_CACHE_FILE.read_text())
+
+    if cached and cached.get('last_edited_time'):
+        updates = query_notion_pages({
+            'timestamp': 'last_edited_time',
+            'last_edited_time': {'on_or_after': cached['last_edited_time']},
+        })
+        pages_by_id = {page['id']: page for page in cached['pages']}
+        pages_by_id.update((page['id'], page) for page in updates)
+        all_results = list(pages_by_id.values())
+        print(f"Merged {len(updates)} updated Notion pages into cache")
+    else:
+        all_results = query_notion_pages()
+
+    if all_results:
+        NOTION_CACHE_FILE.parent.mkdir(parents=True, exist_ok=True)
+        NOTION_CACHE_FILE.write_text(json.dumps({
+            'last_edited_time': max(page.get('last_edited_time', '') for page in all_results),
+            'pages': all_results,
+        }))
+
+    return [parse_notion_page(page) for page in all_results]
 
 def get_excel_contracts():
     """Parse Excel file (HTML table format)"""
-    # Read HTML tables from the file
-    dfs = pd.read_html(EXCEL_FILE)
+    # Read HTML tables from the file (lxml only; no slow BeautifulSoup retry)
+    dfs = pd.read_html(EXCEL_FILE, flavor='lxml')
     df = dfs[0]  # First table
 
     # The columns are in the first row (header)
     print(f"Columns found: {df.columns.tolist()}")
 
-    # Group by Account Name and sum values
-    contracts_dict = {}
-    for _, row in df.iterrows():
-        account_name = str(row.get('Account Name', '')).strip()
-
-        # Get opportunity revenue value
-        value = 0
-        try:
-            value = float(row.get('Est. Opportunity Rev.', 0) or 0)
-        except:
-            value = 0
-
-        close_date = str(row.get('Contract Effective/Close Date', ''))
-        stage = str(row.get('Calculated Stage', ''))
-        sales_lead = str(row.get('Sales Lead (O)', ''))
-
-        if account_name and account_name != 'nan':
-            if account_name not in contracts_dict:
-                contracts_dict[account_name] = {
-                    'name': account_name,
-                    'name_lower': account_name.lower(),
-                    'value': 0,
-                    'close_date': close_date,
-                    'stage': stage,
-                    'sales_lead': sales_lead,
-                    'opportunity_count': 0,
-                }
-            contracts_dict[account_name]['value'] += value
-            contracts_dict[account_name]['opportunity_count'] += 1
-
-    return list(contracts_dict.values())
-
+    def column(name, default):
+        return df[name] if name in df else pd.Series(default, index=df.index)
+
+    # Group by Account Name and sum values. Text cells go through str() so blanks
+    # become 'nan' as before (astype(str) keeps NaN for string dtypes), and
+    # 'first' below really takes the first row instead of skipping nulls.
+    df = pd.DataFrame({
+        'name': column('Account Name', '').map(str).str.strip(),
+        'value': pd.to_numeric(column('Est. Opportunity Rev.', 0), errors='coerce').fillna(0),
+        'close_date': column('Contract Effective/Close Date', '').map(str),
+        'stage': column('Calculated Stage', '').map(str),
+        'sales_lead': column('Sales Lead (O)', '').map(str),
+    })
+    df = df[df['name'].ne('') & df['name'].ne('nan')]
+
+    agg = df.groupby('name', sort=False).agg(
+        value=('value', 'sum'),
+        close_date=('close_date', 'first'),
+        stage=('stage', 'first'),
+        sales_lead=('sales_lead', 'first'),
+        opportunity_count=('value', 'size'),
+    ).reset_index()
+    agg['name_lower'] = agg['name'].str.lower()
+
+    # Build records from whole columns (tolist gives native Python values)
+    # rather than a per-row dict from to_dict('records')
+    columns = [agg[f.name].tolist() for f in fields(ExcelContract)]
+    return [ExcelContract(*values) for values in zip(*columns)]
+
+@lru_cache(maxsize=4096)
 def normalize_name(name):
     """Normalize company name for matching"""
     name = name.lower().strip()
     # Remove common suffixes and patterns
-    for suffix in [', inc.', ', inc', ' inc.', ' inc', ', llc', ' llc', ', ltd', ' ltd',
-                   ' corporation', ' corp', ' company', ' co.', ', city of', ' city of',
-                   ', town of', ' town of', ' department', ' dept', ' utilities', ' utility',
-                   ' water district', ' water division', ' water works', ' waterworks',
-                   ' water & sewer', ' water and sewer', ' mcc', ' m3', ' myc', ' (vf-10)',
-                   ' (1 of 3)', ' (1 of 5)', ' (2 of 5)', ' (3 of 5)', '(console upgrade)',
-                   ' - mcc only', ' mcc only', ' renewal', ' license']:
-        name = name.replace(suffix, '')
+    name = _SUFFIX_RE.sub('', name)
     # Remove anything in parentheses at end
-    import re
-    name = re.sub(r'\s*\([^)]*\)\s*$', '', name)
-    name = re.sub(r'\s*\[[^\]]*\]\s*$', '', name)
+    name = _TRAILING_PARENS_RE.sub('', name)
+    name = _TRAILING_BRACKETS_RE.sub('', name)
     # Clean extra whitespace
-    name = ' '.join(name.split())
-    return name.strip()
+    return ' '.join(name.split())
 
-def reconcile():
+def reconcile(use_cache=False):
     """Compare Excel and Notion contracts"""
     print("=" * 70)
     print("MARS CONTRACTS RECONCILIATION REPORT")
     print(f"Generated: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
     print("=" * 70)
 
-    # Fetch data
-    print("\nFetching Notion contracts...")
-    notion_contracts = get_notion_contracts()
+    # Fetch data, parsing the Excel file while Notion pages download
+    print("\nFetching Notion contracts and parsing Excel file...")
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        excel_future = pool.submit(get_excel_contracts)
+        notion_contracts = get_notion_contracts(use_cache)
+        excel_contracts = excel_future.result()
     print(f"Found {len(notion_contracts)} contracts in Notion")
-
-    print("\nParsing Excel file...")
-    excel_contracts = get_excel_contracts()
     print(f"Found {len(excel_contracts)} contracts in Excel")
 
-    # Create normalized name sets
-    notion_names = {normalize_name(c['name']): c for c in notion_contracts}
-    excel_names = {normalize_name(c['name']): c for c in excel_contracts}
-
-    # Find matches and differences
-    matched = []
-    only_in_excel = []
-    only_in_notion = []
-
-    for norm_name, excel_contract in excel_names.items():
-        if norm_name in notion_names:
-            matched.append({
-                'name': excel_contract['name'],
-                'excel_value': excel_contract['value'],
-                'notion_value': notion_names[norm_name]['value'],
-            })
-        else:
-            only_in_excel.append(excel_contract)
-
-    for norm_name, notion_contract in notion_names.items():
-        if norm_name not in excel_names:
-            only_in_notion.append(notion_contract)
+    # Index by normalized name and total values in a single pass over each list
+    notion_names = {}
+    notion_total = 0
+    for c in notion_contracts:
+        notion_names[normalize_name(c.name)] = c
+        notion_total += c.value
+
+    excel_names = {}
+    excel_total = 0
+    for c in excel_contracts:
+        excel_names[normalize_name(c.name)] = c
+        excel_total += c.value
+
+    # Find matches and differences (iterating the dicts keeps report order)
+    matched_keys = excel_names.keys() & notion_names.keys()
+    matched = [
+        {
+            'name': excel_contract.name,
+            'excel_value': excel_contract.value,
+            'notion_value': notion_names[norm_name].value,
+        }
+        for norm_name, excel_contract in excel_names.items()
+        if norm_name in matched_keys
+    ]
+    only_in_excel = [c for norm_name, c in excel_names.items() if norm_name not in matched_keys]
+    only_in_notion = [c for norm_name, c in notion_names.items() if norm_name not in matched_keys]
 
     # Print report
     print("\n" + "=" * 70)
@@ -167,9 +250,6 @@ def reconcile():
     print(f"Only in Notion:           {len(only_in_notion)}")
 
     # Value analysis
-    excel_total = sum(c['value'] for c in excel_contracts)
-    notion_total = sum(c['value'] for c in notion_contracts)
-
     print(f"\nTotal Excel Value:  ${excel_total:,.0f}")
     print(f"Total Notion Value: ${notion_total:,.0f}")
     print(f"Difference:         ${abs(excel_total - notion_total):,.0f}")
@@ -180,8 +260,8 @@ def reconcile():
         print("=" * 70)
         missing_value = 0
         for i, c in enumerate(only_in_excel, 1):
-            print(f"{i:3}. {c['name'][:45]:<45} ${c['value']:>12,.0f}")
-            missing_value += c['value']
+            print(f"{i:3}. {c.name[:45]:<45} ${c.value:>12,.0f}")
+            missing_value += c.value
         print(f"\n     Missing Value Total: ${missing_value:,.0f}")
 
     if only_in_notion:
@@ -189,7 +269,7 @@ def reconcile():
         print("CONTRACTS ONLY IN NOTION (not in Excel)")
         print("=" * 70)
         for i, c in enumerate(only_in_notion, 1):
-            print(f"{i:3}. {c['name'][:45]:<45} ${c['value']:>12,.0f}")
+            print(f"{i:3}. {c.name[:45]:<45} ${c.value:>12,.0f}")
 
     # Value mismatches
     print("\n" + "=" * 70)
@@ -197,12 +277,17 @@ def reconcile():
     print("=" * 70)
     mismatch_count = 0
     for m in matched:
-        if m['excel_value'] > 0 and m['notion_value'] > 0:
-            diff_pct = abs(m['excel_value'] - m['notion_value']) / max(m['excel_value'], m['notion_value']) * 100
-            if diff_pct > 5:
-                mismatch_count += 1
-                print(f"{m['name'][:40]:<40}")
-                print(f"    Excel: ${m['excel_value']:>12,.0f}  |  Notion: ${m['notion_value']:>12,.0f}  |  Diff: {diff_pct:.1f}%")
+        excel_value, notion_value = m['excel_value'], m['notion_value']
+        # Equal values (the common case) and missing values need no arithmetic
+        if excel_value == notion_value or excel_value <= 0 or notion_value <= 0:
+            continue
+        higher = excel_value if excel_value > notion_value else notion_value
+        diff_pct = abs(excel_value - notion_value) / higher * 100
+        if diff_pct <= 5:
+            continue
+        mismatch_count += 1
+        print(f"{m['name'][:40]:<40}")
+        print(f"    Excel: ${excel_value:>12,.0f}  |  Notion: ${notion_value:>12,.0f}  |  Diff: {diff_pct:.1f}%")
 
     if mismatch_count == 0:
         print("No significant value mismatches found.")
@@ -215,10 +300,15 @@ def reconcile():
     }
 
 if __name__ == '__main__':
-    result = reconcile()
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--cache', action='store_true',
+                        help='Only fetch Notion pages edited since the last run (misses pages deleted in Notion)')
+    args = parser.parse_args()
+
+    result = reconcile(use_cache=args.cache)
 
     # Save missing contracts to JSON for import
     if result['only_in_excel']:
         with open('/Users/jbb/Downloads/MARS-Contracts/missing_contracts.json', 'w') as f:
-            json.dump(result['only_in_excel'], f, indent=2)
+            json.dump([asdict(c) for c in result['only_in_excel']], f, indent=2)
         print(f"\n\nSaved {len(result['only_in_excel'])} missing contracts to missing_contracts.json")
@@ -15,35 +15,46 @@ Environment variables (from .env.local):
     PANDADOC_LOGIN_PASSWORD - PandaDoc login password
     SUPABASE_URL - Supabase project URL
     SUPABASE_SERVICE_ROLE_KEY - Supabase service role key
+    PANDADOC_CAPTURE_URL - Optional lighter authenticated page to load for token capture
+    PANDADOC_LOG_TO_FILE - Set to 0 to log to stderr only (default 1: also pandadoc_refresh.log)
 """
 
+import asyncio
+import fcntl
 import os
+import re
 import sys
 import json
 import logging
-import time
 from pathlib import Path
+from urllib.parse import urlparse
 from datetime import datetime, timezone, timedelta
 
-# Setup logging
-logging.basicConfig(
-    format="%(asctime)s %(levelname)s %(message)s",
-    level=logging.INFO,
-    handlers=[
-        logging.StreamHandler(),
-        logging.FileHandler(Path(__file__).parent / "pandadoc_refresh.log")
-    ]
-)
+import requests
+
+try:
+    import orjson  # C extension; serializes straight to bytes
+except ImportError:
+    orjson = None
+
+# Skip thread/process lookups for record fields the log format never prints
+logging.logThreads = False
+logging.logProcesses = False
+logging.logMultiprocessing = False
+# Don't print handler tracebacks (e.g. a full disk) to stderr; emit errors never
+# propagate either way, so this only silences them
+logging.raiseExceptions = False
+logger = logging.getLogger(__name__)
 
 # Load environment variables
+_ENV_LINE_RE = re.compile(r'^[ \t]*([A-Za-z_][A-Za-z0-9_]*)[ \t]*=(.*)$', re.M)
+
 def load_env():
     env_file = Path(__file__).parent.parent / ".env.local"
     if env_file.exists():
-        for line in env_file.read_text().splitlines():
-            if not line or line.strip().startswith("#") or "=" not in line:
-                continue
-            key, value = line.split("=", 1)
-            os.environ.setdefault(key.strip(), value.strip().strip('"'))
+        # One regex scan over the file; comments and blank lines never match
+        for m in _ENV_LINE_RE.finditer(env_file.read_text()):
+            os.environ.setdefault(m.group(1), m.group(2).strip().strip('"'))
 
 load_env()
 
@@ -53,180 +64,304 @@ PANDADOC_LOGIN_PASSWORD = os.getenv("PANDADOC_LOGIN_PASSWORD")
 SUPABASE_URL = os.getenv("NEXT_PUBLIC_SUPABASE_URL")
 SUPABASE_SERVICE_KEY = os.getenv("SUPABASE_SERVICE_ROLE_KEY")
 
+# Pooled keep-alive session for Supabase REST calls
+SESSION = requests.Session()
+if SUPABASE_SERVICE_KEY:
+    SESSION.headers.update({
+        "apikey": SUPABASE_SERVICE_KEY,
+        "Authorization": f"Bearer {SUPABASE_SERVICE_KEY}",
+        "Content-Type": "application/json",
+        "Prefer": "return=minimal",
+    })
+# Pin a CA bundle; python.org builds on macOS ship without system certs
+try:
+    import certifi
+    SESSION.verify = certifi.where()
+except ImportError:
+    if Path("/etc/ssl/cert.pem").exists():
+        SESSION.verify = "/etc/ssl/cert.pem"
+
+PANDADOC_API_PREFIX = "https://api.pandadoc.com/"
 PANDA_LOGIN_URL = "https://app.pandadoc.com/login/"
 DOCUMENTS_URL = "https://app.pandadoc.com/a/#/documents-next"
+# Any authenticated app page works, as long as its scripts call api.pandadoc.com
+# with the Bearer header (plain navigations to the API only carry cookies)
+CAPTURE_URL = os.getenv("PANDADOC_CAPTURE_URL", DOCUMENTS_URL)
+
+# Skip Chromium subsystems that only slow down a headless cold start;
+# images are disabled natively so they never reach the route handler
+CHROMIUM_ARGS = [
+    "--no-sandbox",
+    "--disable-dev-shm-usage",
+    "--disable-gpu",
+    "--disable-extensions",
+    "--disable-background-networking",
+    "--disable-sync",
+    "--disable-translate",
+    "--disable-default-apps",
+    "--no-first-run",
+    "--disable-features=TranslateUI",
+    "--blink-settings=imagesEnabled=false",
+]
+
+# Only the document, scripts and API calls are needed to capture the token
+BLOCKED_RESOURCE_TYPES = {"font", "media", "stylesheet"}
+TRACKER_HOST_RE = re.compile(r"(segment|googletagmanager|google-analytics|hotjar|fullstory|intercom|mixpanel)")
+
+# Evaluated inside the page on every DOM mutation: "login" once the login form
+# renders, "app" once the signed-in shell does, null until either appears
+PAGE_STATE_JS = """() =>
+    document.querySelector("input[type='email'], #email, input[name='email']") ? "login"
+    : document.querySelector("nav[data-test='top-nav']") ? "app"
+    : null"""
 
 # Storage paths
 SCRIPT_DIR = Path(__file__).parent
-STORAGE_STATE_FILE = SCRIPT_DIR / "panda_storage_state.json"
+# Persistent Chromium profile: keeps cookies, localStorage and HTTP cache between runs.
+# Lives outside the repo since it holds live PandaDoc session cookies.
+PROFILE_DIR = Path.home() / ".cache" / "mars_pandadoc" / "profile"
+# Chromium refuses a profile another instance has open, so runs take this lock first
+PROFILE_LOCK_FILE = PROFILE_DIR.parent / "refresh.lock"
+
+
+async def block_nonessential(route, request):
+    """Abort asset and third-party tracker requests; let everything else through."""
+    if (request.resource_type in BLOCKED_RESOURCE_TYPES
+            or TRACKER_HOST_RE.search(urlparse(request.url).hostname or "")):
+        await route.abort()
+    else:
+        await route.continue_()
+
+
+def has_bearer(request):
+    """Match API calls carrying the Bearer header (Playwright lowercases header names)."""
+    # Cheap URL check before touching the headers
+    return (request.url.startswith(PANDADOC_API_PREFIX)
+            and request.headers.get("authorization", "").lower().startswith("bearer "))
+
 
+async def first_page(context):
+    """Reuse the tab a persistent context opens with, or create one."""
+    return context.pages[0] if context.pages else await context.new_page()
 
-def obtain_token_via_playwright(email: str, password: str, headless: bool = True, max_wait: int = 60):
+
+async def obtain_token_via_playwright(email: str, password: str, headless: bool = True, max_wait: int = 60):
     """
     Launches a browser, logs into PandaDoc, and captures the Bearer token.
     """
     try:
-        from playwright.sync_api import sync_playwright, TimeoutError as PlaywrightTimeoutError
+        from playwright.async_api import async_playwright, TimeoutError as PlaywrightTimeoutError
     except ImportError:
-        logging.error("Playwright not installed. Run: pip3 install playwright && python3 -m playwright install chromium")
+        logger.error("Playwright not installed. Run: pip3 install playwright && python3 -m playwright install chromium")
         sys.exit(1)
 
     if not email or not password:
         raise RuntimeError("Missing PANDADOC_LOGIN_EMAIL or PANDADOC_LOGIN_PASSWORD")
 
-    logging.info("Launching Playwright (headless=%s)...", headless)
+    logger.info("Launching Playwright (headless=%s)...", headless)
 
-    with sync_playwright() as pw:
-        browser = pw.chromium.launch(headless=headless)
-        context = browser.new_context(
-            storage_state=str(STORAGE_STATE_FILE) if STORAGE_STATE_FILE.exists() else None
+    async with async_playwright() as pw:
+        PROFILE_DIR.mkdir(parents=True, exist_ok=True)
+        context = await pw.chromium.launch_persistent_context(
+            str(PROFILE_DIR), headless=headless, args=CHROMIUM_ARGS
+        )
+        # Fail fast on missing elements and stalled navigations instead of the 30s defaults
+        context.set_default_timeout(5000)
+        context.set_default_navigation_timeout(20000)
+        # Register request blocking and grab the page concurrently
+        _, page = await asyncio.gather(
+            context.route("**/*", block_nonessential),
+            first_page(context),
         )
-        page = context.new_page()
-
-        bearer_holder = {"token": None}
-
-        def on_request(request):
-            if bearer_holder["token"]:
-                return
-            try:
-                url = request.url
-                if "api.pandadoc.com" not in url:
-                    return
-                headers = request.headers
-                auth = headers.get("authorization") or headers.get("Authorization")
-                if auth and auth.lower().startswith("bearer "):
-                    token = auth.split(" ", 1)[1].strip()
-                    if token:
-                        bearer_holder["token"] = token
-                        logging.info("Captured Bearer token (length=%d)", len(token))
-            except Exception as e:
-                logging.warning("on_request handler error: %s", e)
-
-        page.on("request", on_request)
-
-        logging.info("Navigating to Documents UI...")
-        page.goto(DOCUMENTS_URL, wait_until="domcontentloaded", timeout=60000)
-
-        # Check if login is needed
-        login_needed = False
+
+        logger.info("Navigating to %s...", CAPTURE_URL)
         try:
-            page.wait_for_selector("input[type='email'], #email, input[name='email']", timeout=5000)
-            login_needed = True
-            logging.info("Login form detected")
+            # The driver resolves the waiter on the first matching request, so the
+            # token is picked up the moment PandaDoc's scripts send it
+            async with page.expect_request(has_bearer, timeout=max_wait * 1000) as bearer_request:
+                await page.goto(CAPTURE_URL, wait_until="domcontentloaded")
+
+                # Race the page-state probe against a token from the existing session,
+                # so a still-valid session never waits out the probe timeout.
+                # token_ready is never cancelled: that would cancel the waiter itself.
+                token_ready = asyncio.create_task(bearer_request.value)
+                page_state = asyncio.create_task(
+                    page.wait_for_function(PAGE_STATE_JS, polling="mutation", timeout=10000)
+                )
+                done, _ = await asyncio.wait({page_state, token_ready}, return_when=asyncio.FIRST_COMPLETED)
+                page_state.cancel()
+
+                state = None
+                if page_state in done and page_state.exception() is None:
+                    state = await page_state.result().json_value()
+
+                login_needed = state == "login"
+                if login_needed:
+                    logger.info("Login form detected")
+                elif token_ready in done:
+                    logger.info("Token captured from existing session")
+                elif state == "app":
+                    logger.info("Already logged in - using existing session")
+                else:
+                    logger.info("No login form - using existing session")
+
+                if login_needed:
+                    # Fill email and password (one union selector each, resolved in a single call).
+                    # Kept sequential: fill types into the focused element, so concurrent
+                    # fills could land in the wrong field
+                    await page.locator("#email, input[name='email'], input[type='email']").first.fill(email)
+                    await page.locator("#password, input[name='password'], input[type='password']").first.fill(password)
+
+                    # Submit
+                    try:
+                        await page.get_by_role("button", name="Log in").click()
+                    except Exception:
+                        await page.click("button[type='submit']")
+
+                    logger.info("Submitted login form...")
+
+                # Wait for token
+                logger.info("Waiting for Bearer token...")
+                request = await token_ready
+            token_value = request.headers["authorization"].split(" ", 1)[1].strip()
         except PlaywrightTimeoutError:
-            logging.info("No login form - using existing session")
-
-        if login_needed:
-            # Fill email
-            for sel in ["#email", "input[name='email']", "input[type='email']"]:
-                try:
-                    page.fill(sel, email)
-                    break
-                except Exception:
-                    continue
-
-            # Fill password
-            for sel in ["#password", "input[name='password']", "input[type='password']"]:
-                try:
-                    page.fill(sel, password)
-                    break
-                except Exception:
-                    continue
-
-            # Submit
-            try:
-                page.get_by_role("button", name="Log in").click()
-            except Exception:
-                page.click("button[type='submit']")
-
-            logging.info("Submitted login form...")
-            try:
-                page.wait_for_load_state("networkidle", timeout=60000)
-            except PlaywrightTimeoutError:
-                pass
-
-        # Wait for token
-        logging.info("Waiting for Bearer token...")
-        start = time.time()
-        while not bearer_holder["token"] and (time.time() - start) < max_wait:
-            page.wait_for_timeout(1000)
-
-        token_value = bearer_holder["token"]
+            token_value = None
+
+        await context.close()
         if not token_value:
-            context.storage_state(path=str(STORAGE_STATE_FILE))
-            browser.close()
             raise RuntimeError("Failed to capture Bearer token")
 
-        logging.info("Successfully captured token: %s...", token_value[:12])
-        context.storage_state(path=str(STORAGE_STATE_FILE))
-        browser.close()
+        logger.info("Successfully captured token: %s...", token_value[:12])
         return token_value
 
 
+def token_still_fresh(min_remaining=timedelta(hours=48)):
+    """
+    Returns the stored token's expiry if it is further than min_remaining away,
+    otherwise None. Any lookup problem means "refresh anyway".
+    """
+    if not SUPABASE_URL or not SUPABASE_SERVICE_KEY:
+        return None
+    try:
+        response = SESSION.get(
+            f"{SUPABASE_URL}/rest/v1/pandadoc_config?id=eq.1&select=token_expires_at", timeout=5
+        )
+        response.raise_for_status()
+        expires = datetime.fromisoformat(response.json()[0]["token_expires_at"])
+        # token_expires_at is timestamptz, but read an offset-less value as UTC
+        if expires.tzinfo is None:
+            expires = expires.replace(tzinfo=timezone.utc)
+        if expires - datetime.now(timezone.utc) > min_remaining:
+            return expires
+    except (requests.RequestException, ValueError, KeyError, IndexError, TypeError) as e:
+        logger.warning("Could not read current token expiry: %s", e)
+    return None
+
+
 def update_supabase_token(token: str):
     """
     Updates the token in Supabase pandadoc_config table.
+    Returns the new expiry timestamp on success, None on failure.
     """
-    import subprocess
-
     if not SUPABASE_URL or not SUPABASE_SERVICE_KEY:
         raise RuntimeError("Missing SUPABASE_URL or SUPABASE_SERVICE_ROLE_KEY")
 
-    url = f"{SUPABASE_URL}/rest/v1/pandadoc_config?id=eq.1"
-    expires_at = (datetime.now(timezone.utc) + timedelta(days=10)).isoformat()
+    # RPC stores the token and increments refresh_count atomically in the DB
+    url = f"{SUPABASE_URL}/rest/v1/rpc/increment_pandadoc_refresh"
+    expires = (datetime.now(timezone.utc) + timedelta(days=10)).isoformat()
 
-    data = json.dumps({
-        "api_token": token,
-        "token_expires_at": expires_at,
-        "last_refreshed_at": datetime.now(timezone.utc).isoformat(),
-        "refresh_count": 1
-    })
+    body = {"p_token": token, "p_expires": expires}
+    payload = orjson.dumps(body) if orjson else json.dumps(body).encode()
 
-    # Use curl to avoid Python SSL issues on macOS
-    result = subprocess.run([
-        "curl", "-s", "-w", "%{http_code}", "-o", "/dev/null",
-        "-X", "PATCH", url,
-        "-H", f"apikey: {SUPABASE_SERVICE_KEY}",
-        "-H", f"Authorization: Bearer {SUPABASE_SERVICE_KEY}",
-        "-H", "Content-Type: application/json",
-        "-H", "Prefer: return=minimal",
-        "-d", data
-    ], capture_output=True, text=True)
-
-    status_code = result.stdout.strip()
-    if status_code in ("200", "204"):
-        logging.info("Supabase update successful (status=%s)", status_code)
-        return True
+    try:
+        response = SESSION.post(url, data=payload, timeout=10)
+    except requests.RequestException as e:
+        logger.error("Supabase update failed: %s", e)
+        return None
+
+    if response.status_code in (200, 204):
+        logger.info("Supabase update successful (status=%s)", response.status_code)
+        return expires
     else:
-        logging.error("Supabase update failed: status=%s, stderr=%s", status_code, result.stderr)
-        return False
+        logger.error("Supabase update failed: status=%s, body=%s", response.status_code, response.text[:200])
+        return None
+
+
+def acquire_profile_lock():
+    """
+    Takes an exclusive, non-blocking lock on PROFILE_LOCK_FILE.
+    Returns the open lock file (held until it is closed or the process exits),
+    or None if another refresh already holds it.
+    """
+    PROFILE_LOCK_FILE.parent.mkdir(parents=True, exist_ok=True)
+    lock_file = open(PROFILE_LOCK_FILE, "w")
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        lock_file.close()
+        return None
+    return lock_file
+
+
+def setup_logging():
+    """Configure logging on first use, so importing the script never touches disk."""
+    handlers = [logging.StreamHandler()]
+    file_error = None
+    if os.getenv("PANDADOC_LOG_TO_FILE", "1") == "1":
+        # FileHandler opens the file up front; an unwritable log file shouldn't
+        # stop the refresh, so fall back to stderr only
+        try:
+            handlers.append(logging.FileHandler(SCRIPT_DIR / "pandadoc_refresh.log"))
+        except OSError as e:
+            file_error = e
+    logging.basicConfig(
+        format="%(asctime)s %(levelname)s %(message)s",
+        level=logging.INFO,
+        handlers=handlers
+    )
+    if file_error:
+        logger.warning("Logging to stderr only; cannot open log file: %s", file_error)
 
 
 def main():
-    logging.info("=" * 50)
-    logging.info("PandaDoc Token Refresh Starting")
-    logging.info("=" * 50)
+    setup_logging()
+    logger.info("=" * 50)
+    logger.info("PandaDoc Token Refresh Starting")
+    logger.info("=" * 50)
 
     try:
+        # Skip the browser entirely while the stored token has plenty of life left;
+        # the lookup also opens the pooled connection the RPC call reuses
+        expires = token_still_fresh()
+        if expires:
+            logger.info("Token still fresh (expires %s), skipping refresh", expires.isoformat())
+            return
+
+        # Overlapping cron runs would share the Chromium profile; let the first one finish
+        profile_lock = acquire_profile_lock()
+        if profile_lock is None:
+            logger.info("Another refresh is running, skipping")
+            return
+
         # Get fresh token
-        token = obtain_token_via_playwright(
+        token = asyncio.run(obtain_token_via_playwright(
             PANDADOC_LOGIN_EMAIL,
             PANDADOC_LOGIN_PASSWORD,
             headless=True,
             max_wait=120
-        )
+        ))
 
         # Update Supabase
-        if update_supabase_token(token):
-            logging.info("Token refresh complete!")
-            logging.info("New token expires: %s",
-                        (datetime.now(timezone.utc) + timedelta(days=10)).isoformat())
+        expires = update_supabase_token(token)
+        if expires:
+            logger.info("Token refresh complete!")
+            logger.info("New token expires: %s", expires)
         else:
-            logging.error("Failed to update Supabase")
+            logger.error("Failed to update Supabase")
             sys.exit(1)
 
     except Exception as e:
-        logging.error("Token refresh failed: %s", e)
+        logger.error("Token refresh failed: %s", e)
         sys.exit(1)
 
 
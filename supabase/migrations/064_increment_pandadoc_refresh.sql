@@ -0,0 +1,15 @@
+-- Migration: Atomic PandaDoc token refresh
+-- Purpose: Store a refreshed token and bump refresh_count in a single statement,
+-- so overlapping refresh runs can't clobber each other's count
+
+CREATE OR REPLACE FUNCTION increment_pandadoc_refresh(p_token TEXT, p_expires TIMESTAMPTZ)
+RETURNS VOID AS $$
+    UPDATE pandadoc_config
+    SET api_token = p_token,
+        token_expires_at = p_expires,
+        last_refreshed_at = NOW(),
+        refresh_count = COALESCE(refresh_count, 0) + 1
+    WHERE id = 1;
+$$ LANGUAGE sql;
+
+COMMENT ON FUNCTION increment_pandadoc_refresh(TEXT, TIMESTAMPTZ) IS 'Called by scripts/refresh_pandadoc_token.py after capturing a new token';